@@ -0,0 +1,12 @@
+-- セッションのカウントログが長くなった時に退避する古い区間
+create table if not exists count_log_segments (
+    id         uuid        primary key,
+    username   text        not null,
+    session_id text        not null,
+    start_ts   timestamptz not null,
+    end_ts     timestamptz not null,
+    logs       jsonb       not null,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists count_log_segments_user_idx on count_log_segments (username, start_ts);
@@ -0,0 +1,8 @@
+-- ローカル複製との同期用（id ごとに updated_at が新しい方を採用する）
+alter table records add column if not exists updated_at timestamptz;
+
+-- users はローカルから username で upsert する
+create unique index if not exists users_username_key on users (username);
+
+-- ローカル複製はユーザごとに updated_at より後の分だけを取り込む
+create index if not exists records_username_updated_at_idx on records (username, updated_at);
@@ -0,0 +1,93 @@
+-- ランキング用のユーザ×週/月の集計テーブル
+-- records の追加・更新・削除のたびに、下のトリガが該当する週・月の行を再集計する
+create table if not exists user_stats (
+    username     text        not null,
+    period       text        not null check (period in ('week', 'month')),
+    period_start date        not null,
+    profit       bigint      not null default 0,
+    timed_profit bigint      not null default 0,
+    core         integer     not null default 0,
+    runs         integer     not null default 0,
+    minutes      real        not null default 0,
+    primary key (username, period, period_start)
+);
+
+-- ランキングは period + period_start で1回だけ取得する
+create index if not exists user_stats_period_idx on user_stats (period, period_start);
+
+-- G/時間の計算に使う周回時間（カウント履歴の経過分）
+alter table records add column if not exists minutes real;
+
+-- 1ユーザの、p_date を含む週（月曜始まり）と月の集計を records から作り直す
+-- G/時間は時間が記録されているレコードの利益（timed_profit）を minutes で割る
+create or replace function refresh_user_stats(p_username text, p_date date) returns void
+language plpgsql security definer as $$
+declare
+    p       text;
+    p_start date;
+begin
+    foreach p in array array['week', 'month'] loop
+        p_start := date_trunc(p, p_date)::date;
+        insert into user_stats (username, period, period_start, profit, timed_profit, core, runs, minutes)
+        select
+            p_username,
+            p,
+            p_start,
+            coalesce(sum(r.profit), 0),
+            coalesce(sum(r.profit) filter (where r.minutes > 0), 0),
+            coalesce(sum(r.core), 0),
+            coalesce(sum(coalesce(r.frag_45, 0) + coalesce(r.frag_75, 0) + coalesce(r.core, 0) + coalesce(r.wipes, 0)), 0),
+            coalesce(sum(r.minutes), 0)
+        from records r
+        where r.username = p_username
+          and r.date::date >= p_start
+          and r.date::date < p_start + ('1 ' || p)::interval
+        on conflict (username, period, period_start) do update set
+            profit       = excluded.profit,
+            timed_profit = excluded.timed_profit,
+            core         = excluded.core,
+            runs         = excluded.runs,
+            minutes      = excluded.minutes;
+    end loop;
+end;
+$$;
+
+create or replace function records_refresh_user_stats() returns trigger
+language plpgsql security definer as $$
+begin
+    if tg_op in ('UPDATE', 'DELETE') and old.date is not null then
+        perform refresh_user_stats(old.username, old.date::date);
+    end if;
+    if tg_op in ('INSERT', 'UPDATE') and new.date is not null then
+        perform refresh_user_stats(new.username, new.date::date);
+    end if;
+    return null;
+end;
+$$;
+
+drop trigger if exists records_refresh_user_stats on records;
+create trigger records_refresh_user_stats
+    after insert or update or delete on records
+    for each row execute function records_refresh_user_stats();
+
+-- 既存レコードからの一括集計（導入時に1回実行）
+insert into user_stats (username, period, period_start, profit, timed_profit, core, runs, minutes)
+select
+    r.username,
+    p.period,
+    date_trunc(p.period, r.date::date)::date as period_start,
+    coalesce(sum(r.profit), 0),
+    coalesce(sum(r.profit) filter (where r.minutes > 0), 0),
+    coalesce(sum(r.core), 0),
+    coalesce(sum(coalesce(r.frag_45, 0) + coalesce(r.frag_75, 0) + coalesce(r.core, 0) + coalesce(r.wipes, 0)), 0),
+    coalesce(sum(r.minutes), 0)
+from records r
+cross join (values ('week'), ('month')) as p(period)
+where r.date is not null
+group by r.username, p.period, date_trunc(p.period, r.date::date)
+on conflict (username, period, period_start) do update set
+    profit       = excluded.profit,
+    timed_profit = excluded.timed_profit,
+    core         = excluded.core,
+    runs         = excluded.runs,
+    minutes      = excluded.minutes;
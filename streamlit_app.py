@@ -3,13 +3,22 @@ import math
 import streamlit as st
 # from streamlit_autorefresh import st_autorefresh
 from supabase import create_client, Client
+from postgrest.exceptions import APIError
+import httpx
 import time
 import pandas as pd
 from pytz import timezone
 import uuid
 # from oauth2client.service_account import ServiceAccountCredentials
 from datetime import datetime, timezone as dt_timezone, timedelta
-import base64, os
+import base64, os, sys
+import json
+import sqlite3
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 
 st.set_page_config(
@@ -58,6 +67,14 @@ class SupabaseDB:
             .order("date", desc=False) \
             .execute()
         return pd.DataFrame(response.data)
+    def get_records_updated_since(self, username: str, since: str):
+        # since より後に更新されたレコードだけを取得する（ローカル複製の差分取り込み用）
+        response = self.client.table("records") \
+            .select("*") \
+            .eq("username", username) \
+            .gt("updated_at", since) \
+            .execute()
+        return pd.DataFrame(response.data)
     def update_record(self, record_id: str, new_values: dict):
         response = self.client.table("records") \
             .update(new_values) \
@@ -92,13 +109,688 @@ class SupabaseDB:
         except Exception as e:
             print(f"最新価格取得失敗({item_name}): {e}")
         return None
+    def add_count_log_segment(self, username: str, session_id: str, logs: list):
+        """古いカウントログの区間を count_log_segments に退避"""
+        try:
+            data = count_log_segment_row(username, session_id, logs)
+            self.client.table("count_log_segments").insert(data).execute()
+            return True
+        except Exception as e:
+            print(f"カウントログ退避失敗: {e}")
+            return False
+    def get_leaderboard(self, period: str, period_start: str):
+        # 指定した週/月の全ユーザ集計を取得する
+        response = self.client.table("user_stats") \
+            .select("username,profit,timed_profit,core,runs,minutes") \
+            .eq("period", period) \
+            .eq("period_start", period_start) \
+            .execute()
+        return pd.DataFrame(response.data)
+
+def _utc_now() -> str:
+    return datetime.now(dt_timezone.utc).isoformat()
+
+def _ts_key(value) -> pd.Timestamp:
+    """updated_at などの比較用（形式の違いを吸収し、空なら最古）"""
+    ts = pd.to_datetime(value, errors="coerce", utc=True)
+    return pd.Timestamp.min.tz_localize("UTC") if pd.isna(ts) else ts
+
+def _json_default(value):
+    # numpy の数値や日付を JSON にできる形へ
+    if hasattr(value, "item"):
+        return value.item()
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+def _json_safe(value):
+    """NaN/inf は JSON（PostgREST）に送れないので None にする"""
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if isinstance(value, dict):
+        return {k: _json_safe(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_json_safe(v) for v in value]
+    return value
 
-def calculate_profit(frag_45, frag_75, core, wipes, meal_cost, meal_num, cost, price):
+def count_log_segment_row(username: str, session_id: str, logs: list) -> dict:
+    """count_log_segments に書き込む1行"""
+    return {
+        "id": str(uuid.uuid4()),
+        "username": username,
+        "session_id": session_id,
+        "start_ts": pd.Timestamp(logs[0]["ts"]).isoformat(),
+        "end_ts": pd.Timestamp(logs[-1]["ts"]).isoformat(),
+        "logs": [{**x, "ts": pd.Timestamp(x["ts"]).isoformat()} for x in logs],
+    }
+
+class LocalReplica:
+    """
+    records / users / 最新価格 / ランキングのローカル複製（SQLite）
+    読み込みはすべてローカルから行い、書き込みはローカルに反映して changes（追記のみ）に積む
+    sync() で changes を Supabase へ送り、リモートの更新を取り込む（id ごとに updated_at が新しい方を採用）
+    ページからはリモートを待たない（初めて見るユーザ・価格・ランキングの期間の取得だけは例外）
+    SupabaseDB と同じメソッドを持つのでそのまま置き換えられる
+    """
+    PRICE_TTL = 600  # 秒。これより古い価格は同期で取り直す
+    LEADERBOARD_TTL = 300  # 秒。これより古いランキングは同期で取り直す
+    TRACK_SECONDS = 3600  # 秒。この間読まれていないユーザ・ランキングは同期の対象から外す
+    FULL_PULL_SECONDS = 3600  # 秒。リモートで消されたレコードを見つけるための全件取得の間隔
+    PULL_OVERLAP_SECONDS = 300  # 秒。端末ごとの時計のずれを見込んで差分取得を少し前から行う
+    MAX_ATTEMPTS = 5  # 送れない変更はこの回数で諦める（通信エラーは数えない）
+    TRANSPORT_ERRORS = (httpx.TimeoutException, httpx.NetworkError)  # 次回そのまま再送するエラー
+
+    def __init__(self, remote: SupabaseDB, path: str):
+        self.remote = remote
+        self.lock = threading.Lock()
+        self.wake = threading.Event()  # 同期を待たずにすぐ回したい時に set する
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            create table if not exists records (
+                id text primary key, username text, date text, updated_at text, data text);
+            create index if not exists records_user_idx on records (username, date);
+            create table if not exists users (
+                username text primary key, last_activity text, data text);
+            create table if not exists prices (
+                item_id text primary key, p5_price real, fetched_at real);
+            create table if not exists leaderboards (
+                period text, period_start text, data text, fetched_at real, requested_at real,
+                primary key (period, period_start));
+            create table if not exists changes (
+                seq integer primary key autoincrement, tbl text, op text, row_id text,
+                payload text, ts text, pushed integer default 0, attempts integer default 0, error text);
+            create table if not exists tracked_users (
+                username text primary key, last_read real, pulled_until text, full_pulled_at real);
+        """)
+        # 古い複製ファイルに後から足した列
+        for sql in ("alter table changes add column error text",
+                    "alter table tracked_users add column last_read real",
+                    "alter table tracked_users add column pulled_until text",
+                    "alter table tracked_users add column full_pulled_at real"):
+            try:
+                self.conn.execute(sql)
+            except sqlite3.OperationalError:
+                pass  # 既にある
+        self.conn.commit()
+        self.pull_users()
+
+    # ---- ローカル操作 ----
+    def _execute(self, sql, params=()):
+        with self.lock:
+            cur = self.conn.execute(sql, params)
+            self.conn.commit()
+            return cur.fetchall()
+    def _log_change(self, tbl, op, row_id, payload):
+        self._execute(
+            "insert into changes (tbl, op, row_id, payload, ts) values (?, ?, ?, ?, ?)",
+            (tbl, op, row_id,
+             json.dumps(_json_safe(payload), ensure_ascii=False, allow_nan=False, default=_json_default),
+             _utc_now()),
+        )
+    def _reject(self, seq, error: str):
+        """送れなかった変更を記録（rejected_changes でユーザに見せる）"""
+        print(f"同期できなかった変更({seq}): {error}")
+        self._execute("update changes set pushed = -1, error = ? where seq = ?", (error, seq))
+    def _put_record(self, data: dict):
+        self._execute(
+            "insert or replace into records (id, username, date, updated_at, data) values (?, ?, ?, ?, ?)",
+            (data["id"], data.get("username"), data.get("date"), data.get("updated_at"),
+             json.dumps(data, ensure_ascii=False, default=_json_default)),
+        )
+    def _put_user(self, data: dict):
+        self._execute(
+            "insert or replace into users (username, last_activity, data) values (?, ?, ?)",
+            (data["username"], data.get("last_activity"), json.dumps(data, ensure_ascii=False, default=_json_default)),
+        )
+
+    # ---- SupabaseDB と同じ読み書き ----
+    def add_record(self, record):
+        """取引記録を追加"""
+        try:
+            now = _utc_now()
+            data = {**record, "created_at": record.get("created_at", now), "updated_at": now}
+            data = json.loads(json.dumps(data, default=_json_default))
+            self._put_record(data)
+            self._log_change("records", "upsert", data["id"], data)
+            self.wake.set()
+            return True
+        except Exception as e:
+            print(f"レコード追加失敗: {e}")
+            return False
+    def create_user(self, username: str):
+        # ユーザを作成する
+        data = {"username": username, "last_activity": datetime.now(timezone("Asia/Tokyo")).isoformat()}
+        self._put_user(data)
+        self._log_change("users", "upsert", username, {"username": username})
+        self.wake.set()
+        return data
+    def get_user(self):
+        # ユーザ情報を取得する
+        rows = self._execute("select data from users")
+        if not rows:
+            return pd.DataFrame(columns=["username", "last_activity"])
+        df = pd.DataFrame([json.loads(r[0]) for r in rows])
+        order = df["last_activity"].map(_ts_key).sort_values(ascending=False).index
+        return df.loc[order].reset_index(drop=True)
+    def get_records_by_user(self, username: str):
+        # ユーザに関連するレコードを取得する（初めてのユーザはリモートから取り込んでおく）
+        tracked = self._execute("select 1 from tracked_users where username = ?", (username,))
+        self._execute(
+            "insert into tracked_users (username, last_read) values (?, ?)"
+            " on conflict (username) do update set last_read = excluded.last_read", (username, time.time()))
+        if not tracked:
+            self.pull_records(username)
+        rows = self._execute("select data from records where username = ? order by date", (username,))
+        return pd.DataFrame([json.loads(r[0]) for r in rows])
+    def update_record(self, record_id: str, new_values: dict):
+        rows = self._execute("select data from records where id = ?", (record_id,))
+        data = json.loads(rows[0][0]) if rows else {"id": record_id}
+        values = json.loads(json.dumps({**new_values, "updated_at": _utc_now()}, default=_json_default))
+        data.update(values)
+        self._put_record(data)
+        self._log_change("records", "update", record_id, values)
+        self.wake.set()
+        return data
+    def delete_record(self, record_id: str):
+        rows = self._execute("select username, date from records where id = ?", (record_id,))
+        username, date = rows[0] if rows else (None, None)
+        self._execute("delete from records where id = ?", (record_id,))
+        # 集計の更新に使うので持ち主と日付も残す
+        self._log_change("records", "delete", record_id, {"username": username, "date": date, "updated_at": _utc_now()})
+        self.wake.set()
+    def update_user_last_activity(self, username: str):
+        """ユーザーの最終更新時刻を更新"""
+        now = datetime.now(timezone("Asia/Tokyo")).isoformat()
+        rows = self._execute("select data from users where username = ?", (username,))
+        if rows:
+            self._put_user({**json.loads(rows[0][0]), "last_activity": now})
+        self._log_change("users", "update", username, {"last_activity": now})
+    def get_latest_price(self, item_name: str) -> float | None:
+        """ローカルの価格を返す（古ければ同期で取り直す。まだ無い価格だけはその場で取得）"""
+        rows = self._execute("select p5_price, fetched_at from prices where item_id = ?", (item_name,))
+        if rows:
+            if time.time() - rows[0][1] >= self.PRICE_TTL:
+                self.wake.set()
+            return rows[0][0]
+        return self._fetch_price(item_name)
+    def _fetch_price(self, item_name: str) -> float | None:
+        price = self.remote.get_latest_price(item_name)
+        if price is not None:
+            self._execute(
+                "insert or replace into prices (item_id, p5_price, fetched_at) values (?, ?, ?)",
+                (item_name, price, time.time()),
+            )
+        return price
+
+    # ---- リモート側の退避（同期スレッドで送る） ----
+    def add_count_log_segment(self, username: str, session_id: str, logs: list):
+        data = json.loads(json.dumps(count_log_segment_row(username, session_id, logs), default=_json_default))
+        self._log_change("count_log_segments", "insert", data["id"], data)
+        return True
+    def get_leaderboard(self, period: str, period_start: str):
+        """
+        ローカルのランキングを返す（古い場合は同期で取り直す。初めて見る期間だけはその場で取得）
+        取得できるまでは None
+        """
+        rows = self._execute(
+            "select data, fetched_at from leaderboards where period = ? and period_start = ?", (period, period_start))
+        if not rows:
+            self._execute(
+                "insert or ignore into leaderboards (period, period_start, fetched_at, requested_at) values (?, ?, 0, ?)",
+                (period, period_start, time.time()),
+            )
+            return self._fetch_leaderboard(period, period_start)
+        self._execute(
+            "update leaderboards set requested_at = ? where period = ? and period_start = ?",
+            (time.time(), period, period_start),
+        )
+        if time.time() - rows[0][1] >= self.LEADERBOARD_TTL:
+            self.wake.set()
+        if rows[0][0] is None:
+            return None
+        return pd.DataFrame(json.loads(rows[0][0]))
+    def _fetch_leaderboard(self, period: str, period_start: str):
+        try:
+            df = self.remote.get_leaderboard(period, period_start)
+        except Exception as e:
+            print(f"ランキング取得失敗: {e}")
+            self.wake.set()  # 同期で取り直す
+            return None
+        self._execute(
+            "update leaderboards set data = ?, fetched_at = ? where period = ? and period_start = ?",
+            (df.to_json(orient="records", force_ascii=False), time.time(), period, period_start),
+        )
+        return df
+
+    # ---- 同期 ----
+    def pending_count(self) -> int:
+        return self._execute("select count(*) from changes where pushed = 0")[0][0]
+    def rejected_changes(self):
+        """反映できずに破棄された変更（確認済みのものは除く）"""
+        rows = self._execute(
+            "select ts, tbl, op, row_id, error from changes where pushed = -1 order by seq")
+        return pd.DataFrame(rows, columns=["ts", "tbl", "op", "row_id", "error"])
+    def acknowledge_rejected(self):
+        self._execute("update changes set pushed = -2 where pushed = -1")
+    def _remote_is_newer(self, row_id: str, change_ts) -> bool:
+        """リモートのレコードがこの変更より後に更新されているか"""
+        res = self.remote.client.table("records").select("updated_at").eq("id", row_id).execute()
+        return bool(res.data) and _ts_key(res.data[0].get("updated_at")) > _ts_key(change_ts)
+    def push(self):
+        """未送信の changes を古い順に送る（通信できなければそこで止めて次回に再送）"""
+        rows = self._execute(
+            "select seq, tbl, op, row_id, payload, ts, attempts from changes where pushed = 0 order by seq"
+        )
+        records_pushed = False
+        for seq, tbl, op, row_id, payload, ts, attempts in rows:
+            try:
+                payload = json.loads(payload)
+                table = self.remote.client.table(tbl)
+                key = "id" if tbl in ("records", "count_log_segments") else "username"
+                if tbl == "records" and self._remote_is_newer(row_id, payload.get("updated_at", ts)):
+                    # 後勝ち: リモートの方が新しいのでこの変更は捨て、pull でリモートの内容を取り込む
+                    self._reject(seq, "他の端末でより新しい更新があったため反映しませんでした")
+                    continue
+                if op == "upsert":
+                    table.upsert(payload, on_conflict=key).execute()
+                elif op == "insert":
+                    table.insert(payload).execute()
+                elif op == "update":
+                    table.update(payload).eq(key, row_id).execute()
+                elif op == "delete":
+                    table.delete().eq(key, row_id).execute()
+                self._execute("update changes set pushed = 1 where seq = ?", (seq,))
+                records_pushed = records_pushed or tbl == "records"
+            except self.TRANSPORT_ERRORS as e:
+                # 通信できない間はそのまま残して次回に再送
+                print(f"同期送信失敗({tbl} {op} {row_id}): {e}")
+                break
+            except Exception as e:
+                # サーバの拒否や送れない内容は回数を数え、続くようなら捨てて後ろの変更を通す
+                attempts += 1
+                if attempts >= self.MAX_ATTEMPTS:
+                    reason = "サーバに拒否されました" if isinstance(e, APIError) else "送信できませんでした"
+                    self._reject(seq, f"{reason}: {e}")
+                    continue
+                self._execute("update changes set attempts = ? where seq = ?", (attempts, seq))
+                print(f"同期送信失敗({tbl} {op} {row_id}): {e}")
+                break
+        # user_stats は records のトリガでサーバ側が更新するので、ランキングを取り直すだけ
+        if records_pushed:
+            self._execute("update leaderboards set fetched_at = 0")
+    def pull_users(self):
+        try:
+            remote_users = self.remote.get_user()
+        except Exception as e:
+            print(f"ユーザ取得失敗: {e}")
+            return
+        pending = {r[0] for r in self._execute(
+            "select row_id from changes where tbl = 'users' and pushed = 0")}
+        for row in remote_users.to_dict("records"):
+            if row.get("username") not in pending:
+                self._put_user(json.loads(json.dumps(row, default=_json_default)))
+    def pull_records(self, username: str):
+        """
+        リモートのレコードを取り込む（id ごとに updated_at が新しい方を残す）
+        普段は前回より後に更新された分だけを取り、初めて・FULL_PULL_SECONDS ごとに全件を取って
+        リモートで消されたものをローカルからも消す
+        """
+        rows = self._execute(
+            "select pulled_until, full_pulled_at from tracked_users where username = ?", (username,))
+        pulled_until, full_pulled_at = rows[0] if rows else (None, None)
+        full = pulled_until is None or time.time() - (full_pulled_at or 0) >= self.FULL_PULL_SECONDS
+        try:
+            if full:
+                remote_df = self.remote.get_records_by_user(username)
+            else:
+                since = _ts_key(pulled_until) - pd.Timedelta(seconds=self.PULL_OVERLAP_SECONDS)
+                remote_df = self.remote.get_records_updated_since(username, since.isoformat())
+        except Exception as e:
+            print(f"レコード取得失敗({username}): {e}")
+            return
+        remote_rows = {r["id"]: r for r in json.loads(remote_df.to_json(orient="records", force_ascii=False))} \
+            if not remote_df.empty else {}
+        pending = {}
+        for row_id, ts in self._execute(
+                "select row_id, max(ts) from changes where tbl = 'records' and pushed = 0 group by row_id"):
+            pending[row_id] = ts
+        for row_id, row in remote_rows.items():
+            if row_id in pending:
+                if _ts_key(row.get("updated_at")) <= _ts_key(pending[row_id]):
+                    continue  # ローカルの未送信の変更の方が新しい
+                # リモートの方が新しいのでローカルの未送信の変更は捨てる
+                for (seq,) in self._execute(
+                        "select seq from changes where tbl = 'records' and row_id = ? and pushed = 0", (row_id,)):
+                    self._reject(seq, "他の端末でより新しい更新があったため反映しませんでした")
+            self._put_record(row)
+        if full:
+            # リモートで消されたもの（未送信の変更がないもの）はローカルからも消す
+            local = {r[0] for r in self._execute("select id from records where username = ?", (username,))}
+            for row_id in local - remote_rows.keys() - pending.keys():
+                self._execute("delete from records where id = ?", (row_id,))
+        # 次の差分取得の起点（取り込んだ中で最も新しい updated_at）
+        stamps = [_ts_key(r["updated_at"]) for r in remote_rows.values() if r.get("updated_at")]
+        if pulled_until is not None:
+            stamps.append(_ts_key(pulled_until))
+        self._execute(
+            "update tracked_users set pulled_until = ?, full_pulled_at = ? where username = ?",
+            (max(stamps).isoformat() if stamps else _utc_now(), time.time() if full else full_pulled_at, username),
+        )
+    def pull_prices(self):
+        for (item_id,) in self._execute(
+                "select item_id from prices where fetched_at < ?", (time.time() - self.PRICE_TTL,)):
+            self._fetch_price(item_id)
+    def pull_leaderboards(self):
+        now_ts = time.time()
+        self._execute("delete from leaderboards where requested_at < ?", (now_ts - self.TRACK_SECONDS,))
+        for period, period_start in self._execute(
+                "select period, period_start from leaderboards where fetched_at < ?", (now_ts - self.LEADERBOARD_TTL,)):
+            if self._fetch_leaderboard(period, period_start) is None:
+                return
+    def sync(self):
+        self.push()
+        self.pull_users()
+        # しばらく読まれていないユーザは同期の対象から外す（次に読まれた時に取り込み直す）
+        self._execute("delete from tracked_users where last_read < ?", (time.time() - self.TRACK_SECONDS,))
+        for (username,) in self._execute("select username from tracked_users"):
+            self.pull_records(username)
+        self.pull_prices()
+        self.pull_leaderboards()
+    def sync_forever(self, interval: float):
+        while True:
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"同期失敗: {e}")
+            self.wake.wait(interval)
+            self.wake.clear()
+
+_replica_conf = st.secrets.get("replica", {})
+REPLICA_PATH = _replica_conf.get("path", "replica.db")
+REPLICA_SYNC_SECONDS = float(_replica_conf.get("sync_seconds", 30))
+
+@st.cache_resource
+def get_db() -> LocalReplica:
+    """プロセスで共有するローカル複製（初回にバックグラウンド同期を開始）"""
+    db = LocalReplica(SupabaseDB(), REPLICA_PATH)
+    threading.Thread(target=db.sync_forever, args=(REPLICA_SYNC_SECONDS,), daemon=True).start()
+    return db
+
+def _profit_man(frag_45, frag_75, core, wipes, meal_cost, meal_num, cost, price):
+    """利益を万G単位で返す（スカラーでも numpy 配列でもそのまま計算できる）"""
     commission = 0.05
     profit = price * (frag_45 * 45/99 + frag_75 * 75/99 + core) * (1 - commission)
-    profit -= cost * 30 * (frag_45 + frag_75 + core + wipes) / 4
-    profit -= meal_cost * (meal_num / 5)
-    return int(profit * 10000)
+    profit = profit - cost * 30 * (frag_45 + frag_75 + core + wipes) / 4
+    profit = profit - meal_cost * (meal_num / 5)
+    return profit
+
+def calculate_profit(frag_45, frag_75, core, wipes, meal_cost, meal_num, cost, price):
+    return int(_profit_man(frag_45, frag_75, core, wipes, meal_cost, meal_num, cost, price) * 10000)
+
+# 1周の結果の種類（count_logs の kind / records の列と対応）
+RUN_KINDS = ("欠片45", "欠片75", "核", "全滅")
+_RUN_COLUMNS = ("frag_45", "frag_75", "core", "wipes")
+
+def estimate_run_probs(records_df, count_logs, extra_kinds=None):
+    """
+    records と現在のカウントログから 1周あたりの
+    (欠片45, 欠片75, 核, 全滅) の確率を推定する（各1回分のラプラス平滑化つき）
+    extra_kinds: 退避済みカウントログの種類ごとの件数
+    """
+    tallies = np.ones(len(RUN_KINDS))
+    if records_df is not None and not records_df.empty:
+        cols = [c for c in _RUN_COLUMNS if c in records_df.columns]
+        sums = records_df[cols].apply(pd.to_numeric, errors="coerce").fillna(0).sum()
+        for i, c in enumerate(_RUN_COLUMNS):
+            tallies[i] += float(sums.get(c, 0))
+    for log in count_logs or []:
+        kind = log.get("kind") if isinstance(log, dict) else None
+        if kind in RUN_KINDS:
+            tallies[RUN_KINDS.index(kind)] += 1
+    for kind, n in (extra_kinds or {}).items():
+        if kind in RUN_KINDS:
+            tallies[RUN_KINDS.index(kind)] += n
+    return tallies / tallies.sum()
+
+def _run_values(meal_cost, meal_num, cost, price):
+    """1周ぶんの利益の増分(G)を結果の種類ごとに返す（利益は各周の結果に対して線形）"""
+    base = _profit_man(0, 0, 0, 0, meal_cost, meal_num, cost, price)
+    unit = np.eye(len(RUN_KINDS))
+    return (_profit_man(unit[:, 0], unit[:, 1], unit[:, 2], unit[:, 3], meal_cost, meal_num, cost, price) - base) * 10000
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _simulate_profit_bands(probs, remaining_runs, run_values, n_sims, percentiles, seed):
+    """残り周回の利益の増分をモンテカルロで求め、パーセンタイルを返す（同じ入力ならキャッシュを使う）"""
+    rng = np.random.default_rng(seed)
+    draws = rng.multinomial(remaining_runs, probs, size=n_sims)
+    return tuple(float(v) for v in np.percentile(draws @ np.asarray(run_values), percentiles))
+
+def forecast_profit(probs, counts, remaining_runs, meal_cost, meal_num, cost, price,
+                    n_sims=200_000, percentiles=(5, 25, 50, 75, 95), seed=0):
+    """
+    残り周回を含めた終了時点の利益(G)の分布を返す
+    counts: 現在の (欠片45, 欠片75, 核, 全滅)
+    1周の結果は probs に従う多項分布で利益はその線形和なので、平均と標準偏差は式で求め、
+    パーセンタイルだけ n_sims 回のシミュレーションで求める
+    """
+    remaining_runs = max(0, int(remaining_runs))
+    probs = tuple(round(float(p), 6) for p in probs)
+    values = _run_values(meal_cost, meal_num, cost, price)
+    current = calculate_profit(*counts, meal_cost, meal_num, cost, price)
+    p = np.asarray(probs) / sum(probs)
+    per_run_mean = float(p @ values)
+    per_run_var = float(p @ values**2) - per_run_mean**2
+    bands = (0.0,) * len(percentiles)
+    if remaining_runs:
+        bands = _simulate_profit_bands(
+            tuple(p), remaining_runs, tuple(float(v) for v in values),
+            int(n_sims), tuple(percentiles), seed,
+        )
+    return {
+        "mean": current + remaining_runs * per_run_mean,
+        "std": math.sqrt(max(0.0, remaining_runs * per_run_var)),
+        "percentiles": {int(q): current + v for q, v in zip(percentiles, bands)},
+        "probs": dict(zip(RUN_KINDS, (float(x) for x in p))),
+        "remaining_runs": remaining_runs,
+        "n_sims": int(n_sims) if remaining_runs else 0,
+    }
+
+def _period_start(dates, period: str):
+    """日付を週（月曜始まり）または月の開始日に揃える"""
+    dates = pd.to_datetime(dates, errors="coerce")
+    if period == "week":
+        return dates.dt.to_period("W").dt.start_time.dt.normalize()
+    return dates.dt.to_period("M").dt.to_timestamp()
+
+LEADERBOARD_TTL = LocalReplica.LEADERBOARD_TTL
+
+def load_leaderboard(period: str, period_start: str):
+    """ランキング用の集計を取得（ローカル複製が LEADERBOARD_TTL ごとに取り直す。取得中は None）"""
+    df = st.session_state.supabase.get_leaderboard(period, period_start)
+    if df is None or df.empty:
+        return df
+    hours = df["minutes"].astype(float) / 60
+    df["g_per_hour"] = (df["timed_profit"].astype(float) / hours.where(hours > 0)).round()
+    return df
+
+def _elapsed_minutes(logs, since=None) -> float:
+    """カウントログの先頭（since があればその時刻）から最後の入力までの経過時間（分）"""
+    ts = [x.get("ts") for x in logs or [] if isinstance(x, dict)]
+    if since is not None:
+        ts.insert(0, since)
+    ts = pd.to_datetime(pd.Series(ts), errors="coerce").dropna()
+    if len(ts) < 2:
+        return 0.0
+    return round((ts.max() - ts.min()).total_seconds() / 60, 1)
+
+# ------------------ セッションのメモリ管理 ------------------
+_mem_conf = st.secrets.get("memory", {})
+SESSION_MEMORY_BUDGET = int(float(_mem_conf.get("session_budget_mb", 32)) * 1024 * 1024)
+SESSION_IDLE_SECONDS = int(_mem_conf.get("idle_seconds", 600))
+COUNT_LOG_KEEP = int(_mem_conf.get("count_log_keep", 200))
+SHOW_MEMORY_REPORT = bool(_mem_conf.get("show_report", False))  # 運営者向け（他のユーザ名が見えるため既定は非表示）
+RECORDS_TTL = int(_mem_conf.get("records_ttl", 60))  # 他のタブでの更新を拾うまでの秒数
+
+def _sizeof(value) -> int:
+    """キャッシュする値のおおよそのメモリ使用量（バイト）"""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, str):
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_sizeof(k) + _sizeof(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+class SessionMemory:
+    """
+    1セッションが保持するデータのサイズを記録し、合計が budget を超えたら
+    最近使われていないキャッシュから破棄する（LRU）
+    put したものは破棄されうるキャッシュ、account したものは集計のみ（カウントログなど）
+    attach したカウントログ・入力値は、放置されたときに trim_idle で退避・破棄する
+    """
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.accounted = {}           # key -> size
+        self.username = None
+        self.session_id = ""
+        self.session_data = None      # (count_logs, _spilled_logs, inputs) をそのまま参照で持つ
+        self.lock = threading.RLock()
+        self.last_access = time.time()
+    def get(self, key, default=None):
+        self.last_access = time.time()
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+    def put(self, key, value):
+        self.last_access = time.time()
+        self.entries.pop(key, None)
+        self.entries[key] = (value, _sizeof(value))
+        self._evict()
+        return value
+    def discard(self, key):
+        self.entries.pop(key, None)
+    def clear(self):
+        self.entries.clear()
+    def account(self, key, value):
+        self.accounted[key] = _sizeof(value)
+        self._evict()
+    def attach(self, count_logs, spilled, inputs):
+        """このセッションのカウントログ・入力値を集計に含め、放置時に退避できるよう参照を持つ"""
+        self.session_data = (count_logs, spilled, inputs)
+        self.account("count_logs", count_logs)
+        self.account("inputs", inputs)
+    def trim_idle(self, db):
+        """
+        放置されたセッションのキャッシュを破棄し、カウントログは最後の1件を残してストレージへ退避する
+        （リストと辞書はその場で書き換えるので、戻ってきたセッションにもそのまま反映される）
+        持ち主のセッションが lock を持ってカウントログを触っている間は、次の掃除に回す
+        """
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            self.clear()
+            if self.session_data is None:
+                return
+            count_logs, spilled, inputs = self.session_data
+            if self.username:
+                _spill_logs(db, self.username, self.session_id, count_logs, spilled, keep=1)
+            inputs.clear()
+            self.account("count_logs", count_logs)
+            self.account("inputs", inputs)
+        finally:
+            self.lock.release()
+    def cached_bytes(self) -> int:
+        return sum(size for _, size in self.entries.values())
+    def total_bytes(self) -> int:
+        return self.cached_bytes() + sum(self.accounted.values())
+    def _evict(self):
+        # 直近に put したもの（このランで使う）は残す
+        while len(self.entries) > 1 and self.total_bytes() > self.budget:
+            self.entries.popitem(last=False)
+
+@st.cache_resource
+def _session_registry():
+    """全セッションの SessionMemory（セッションが閉じられると自動的に消える）"""
+    return weakref.WeakValueDictionary()
+
+def session_memory() -> SessionMemory:
+    """このセッションの SessionMemory を返し、放置されたセッションのキャッシュを破棄する"""
+    if "_memory" not in st.session_state:
+        st.session_state._memory = SessionMemory(SESSION_MEMORY_BUDGET)
+    mem = st.session_state._memory
+    mem.last_access = time.time()
+    ctx = get_script_run_ctx()
+    registry = _session_registry()
+    if ctx is not None:
+        mem.session_id = ctx.session_id
+        registry[ctx.session_id] = mem
+    for other in list(registry.values()):
+        if (other is not mem and time.time() - other.last_access > SESSION_IDLE_SECONDS
+                and (other.entries or (other.session_data and len(other.session_data[0]) > 1))):
+            other.trim_idle(st.session_state.supabase)
+    return mem
+
+def memory_report():
+    """セッションごとのメモリ使用量"""
+    rows = []
+    now_ts = time.time()
+    for session_id, mem in list(_session_registry().items()):
+        rows.append({
+            "session": session_id[:8],
+            "user": mem.username or "-",
+            "cache_kb": round(mem.cached_bytes() / 1024, 1),
+            "total_kb": round(mem.total_bytes() / 1024, 1),
+            "entries": len(mem.entries),
+            "idle_s": int(now_ts - mem.last_access),
+        })
+    return pd.DataFrame(rows)
+
+def get_records_cached(username: str):
+    """ユーザのレコードをセッションのキャッシュ経由で取得（書き込み時は invalidate_records で破棄）"""
+    mem = session_memory()
+    cached = mem.get(("records", username))
+    if cached is None or time.time() - cached[0] > RECORDS_TTL:
+        cached = mem.put(("records", username), (time.time(), st.session_state.supabase.get_records_by_user(username)))
+    return cached[1]
+
+def invalidate_records(username: str):
+    session_memory().discard(("records", username))
+
+def _spill_logs(db, username: str, session_id: str, logs: list, spilled: dict, keep: int) -> bool:
+    """
+    logs の直近 keep 件を残して古い区間をストレージへ退避する（logs と spilled はその場で書き換える）
+    退避した件数・種類・開始時刻は spilled に残し、経過時間や確率推定に使う
+    """
+    if len(logs) <= keep:
+        return False
+    old = logs[:len(logs) - keep]
+    if not db.add_count_log_segment(username, session_id, old):
+        return False
+    if spilled["since"] is None:
+        spilled["since"] = old[0]["ts"]
+    spilled["n"] += len(old)
+    for x in old:
+        if x.get("kind") in RUN_KINDS:
+            spilled["kinds"][x["kind"]] = spilled["kinds"].get(x["kind"], 0) + 1
+    del logs[:len(old)]
+    return True
+
+def spill_count_logs(username: str):
+    """カウントログが COUNT_LOG_KEEP 件を超えたら、直近の半分を残して古い区間をストレージへ退避する"""
+    if len(st.session_state.count_logs) <= COUNT_LOG_KEEP:
+        return
+    mem = session_memory()
+    with mem.lock:
+        _spill_logs(
+            st.session_state.supabase, username, mem.session_id,
+            st.session_state.count_logs, st.session_state._spilled_logs, max(1, COUNT_LOG_KEEP // 2),
+        )
 
 def reset_count():
     """_reset_counts=Trueなら次のランで実際に初期化してからフラグを戻す"""
@@ -110,6 +802,7 @@ def reset_count():
     st.session_state._last_core = 0
     st.session_state._last_wipes = 0
     st.session_state.count_logs = []
+    st.session_state._spilled_logs = {"since": None, "n": 0, "kinds": {}}
     st.session_state._flash_msg = ("info", "カウントと履歴をクリアしました")
 
 def record_count(now):
@@ -273,40 +966,26 @@ def _marker_svg(x: float, y: float, size: float, kind: str, title_text: str) ->
         badge_svg = badge_shadow + badge_body + text_outline + text_fill
     return f'<g><title>{title_text}</title>{plate}{image}{badge_svg}</g>'
 
-def render_count_logs(logs, min_span_min=5, warn_minutes=5, title="⏱ カウント履歴"):
-    if not logs or not isinstance(logs, list) or not all(isinstance(x, dict) and "ts" in x for x in logs):
-        st.subheader(title)
-        st.caption("まだカウント履歴はありません。")
-        # ここで開始ボタンを表示（何もカウントがない時）
-        if st.button("⏱ カウント開始", type="secondary"):
-            now_jst = pd.Timestamp.now(tz="Asia/Tokyo")
-            st.session_state.count_logs = [{"ts": now_jst, "kind": "start", "合計": 0}]
-            st.success("カウントを開始しました")
-            st.rerun()
-        return
-    df = pd.DataFrame(logs).copy()
-    df["ts"] = pd.to_datetime(df["ts"], errors="coerce")
-    df = df.dropna(subset=["ts"]).sort_values("ts").reset_index(drop=True)
-    if df.empty:
-        st.subheader(title); st.caption("有効なタイムスタンプがありません。"); return
-    t0 = df["ts"].iloc[0]
-    tzinfo = df["ts"].dt.tz  # tzinfo または None（Series ではない）
-    now = pd.Timestamp.now(tz=tzinfo) if tzinfo is not None else pd.Timestamp.now()
-    df["min_from_start"] = (df["ts"] - t0).dt.total_seconds() / 60.0
-    # 次の入力までの区間（最後は now まで）
-    next_ts = list(df["ts"].iloc[1:]) + [now]
-    df["delta_min"] = (pd.Series(next_ts, dtype="datetime64[ns, UTC]" if tzinfo is not None else "datetime64[ns]") - df["ts"]).dt.total_seconds() / 60.0
-    df["delta_min"] = df["delta_min"].clip(lower=0)
-    total_span = max(float(min_span_min), float(df["min_from_start"].iloc[-1] + df["delta_min"].iloc[-1]))
-    # ---- SVG パラメータ ----
-    W, H = 2000, 70
-    PAD_L, PAD_R = 48, 12
-    Y, BAR_H, MARK_R = H/2, 8, 5
-    def sx(mins): return PAD_L + (W - PAD_L - PAD_R) * (mins / total_span)
-    # 目盛り
+# ---- タイムライン SVG パラメータ ----
+_TL_W, _TL_H = 2000, 70
+_TL_PAD_L, _TL_PAD_R = 48, 12
+_TL_Y, _TL_BAR_H, _TL_MARK_R = _TL_H/2, 8, 5
+_TL_BAR_OPACITY = 0.45
+
+def _tl_x(mins, total_span):
+    return _TL_PAD_L + (_TL_W - _TL_PAD_L - _TL_PAD_R) * (mins / total_span)
+
+def _log_ts(entry):
+    """ログの ts を Timestamp に変換（不正なら None）"""
+    ts = pd.to_datetime(entry.get("ts"), errors="coerce")
+    return None if pd.isna(ts) else ts
+
+def _timeline_ticks(total_span) -> str:
+    """目盛りと軸ラベル（表示幅 total_span だけで決まる）"""
+    Y, BAR_H = _TL_Y, _TL_BAR_H
     ticks = []
     for m in range(0, int(math.ceil(total_span)) + 1):
-        x = sx(m)
+        x = _tl_x(m, total_span)
         is_major = m % 5 == 0
         h = 12 if is_major else 6
         sw = 2 if is_major else 1.2
@@ -319,36 +998,19 @@ def render_count_logs(logs, min_span_min=5, warn_minutes=5, title="⏱ カウン
             ticks.append(
                 f'<text x="{x}" y="{Y+BAR_H+35}" fill="#f9fafb" font-size="18" font-weight="700" text-anchor="middle">{m}</text>'
             )
-
-    axis = "\n".join(ticks)
     axis_label = (
-        f'<text x="{PAD_L-36}" y="{Y+BAR_H+35}" fill="#e5e7eb" font-size="17" font-weight="600">分</text>'
+        f'<text x="{_TL_PAD_L-36}" y="{Y+BAR_H+35}" fill="#e5e7eb" font-size="17" font-weight="600">分</text>'
     )
-    # 区間色
-    segs = []
-    for i in range(len(df)):
-        x0 = sx(df["min_from_start"].iloc[i])
-        x1 = sx(min(df["min_from_start"].iloc[i] + df["delta_min"].iloc[i], total_span))
-        w = max(0.5, x1 - x0)
-        col = _color_by_minutes(df["delta_min"].iloc[i])
-        BAR_OPACITY = 0.45
-        segs.append(
-            f'<rect x="{x0}" y="{Y-BAR_H/2}" width="{w}" height="{BAR_H}" fill="{col}" fill-opacity="{BAR_OPACITY}" />'
-        )
-    # マーカー
-    marks = []
-    for i, r in df.iterrows():
-        x = sx(r["min_from_start"]); y = Y
-        info = f'{r["ts"].strftime("%H:%M:%S")}｜先頭から{r["min_from_start"]:.1f}分｜合計{int(r["合計"])}｜kind:{r.get("kind","-")}'
-        marks.append(_marker_svg(x, y, MARK_R, r.get("kind",""), info))
-    # レジェンド
+    return "\n".join(ticks) + axis_label
+
+def _timeline_legend() -> str:
     legend_defs = [
         ("欠片45", "欠片45"),
         ("欠片75", "欠片75"),
         ("核",     "核"),
         ("全滅",   "全滅"),
     ]
-    legend_x = PAD_L
+    legend_x = _TL_PAD_L
     legend_y = 12
     lg = []
     for label, kind_name in legend_defs:
@@ -372,36 +1034,103 @@ def render_count_logs(logs, min_span_min=5, warn_minutes=5, title="⏱ カウン
         # ラベル文字
         lg.append(f'<text x="{legend_x + 20}" y="{legend_y+1}" fill="#d1d5db" font-size="12">{label}</text>')
         legend_x += 90
+    return "".join(lg)
+
+def _timeline_segment(start_min, delta_min, total_span) -> str:
+    """入力から次の入力（最後は now）までの区間の色付きバー"""
+    delta_min = max(0.0, delta_min)
+    x0 = _tl_x(start_min, total_span)
+    x1 = _tl_x(min(start_min + delta_min, total_span), total_span)
+    w = max(0.5, x1 - x0)
+    col = _color_by_minutes(delta_min)
+    return (
+        f'<rect x="{x0}" y="{_TL_Y-_TL_BAR_H/2}" width="{w}" height="{_TL_BAR_H}" fill="{col}" fill-opacity="{_TL_BAR_OPACITY}" />'
+    )
+
+def render_count_logs(logs, min_span_min=5, warn_minutes=5, title="⏱ カウント履歴", spilled=None, span_step=5):
+    """
+    カウント履歴のタイムラインを描画する
+    確定した区間・マーカー・目盛り・レジェンドは (先頭時刻, 表示幅) をキーにセッションにキャッシュし、
+    再描画では新しい入力の分だけ追記して、now まで伸びる最後の区間だけを作り直す
+    表示幅は span_step 分単位で切り上げる（毎回変わると全座標が変わるため）
+    """
+    if not logs or not isinstance(logs, list) or not all(isinstance(x, dict) and "ts" in x for x in logs):
+        st.subheader(title)
+        st.caption("まだカウント履歴はありません。")
+        # ここで開始ボタンを表示（何もカウントがない時）
+        if st.button("⏱ カウント開始", type="secondary"):
+            now_jst = pd.Timestamp.now(tz="Asia/Tokyo")
+            st.session_state.count_logs = [{"ts": now_jst, "kind": "start", "合計": 0}]
+            st.success("カウントを開始しました")
+            st.rerun()
+        return
+    t0 = next((ts for ts in map(_log_ts, logs) if ts is not None), None)
+    if t0 is None:
+        st.subheader(title); st.caption("有効なタイムスタンプがありません。"); return
+    now = pd.Timestamp.now(tz=t0.tz) if t0.tz is not None else pd.Timestamp.now()
+    elapsed = max(0.0, (now - t0).total_seconds() / 60.0)
+    total_span = max(float(min_span_min), float(math.ceil(elapsed / span_step) * span_step))
 
+    # キャッシュが使えるか（先頭・表示幅が同じで、前回までのログがそのまま残っている）
+    mem = session_memory()
+    cache = mem.get("count_log_svg")
+    key = (t0, total_span)
+    if (cache is None or cache["key"] != key or len(logs) < cache["n_raw"]
+            or (cache["n_raw"] and logs[cache["n_raw"] - 1]["ts"] != cache["last_raw_ts"])):
+        cache = {
+            "key": key, "n_raw": 0, "last_raw_ts": None,
+            "n_events": 0, "first_kind": None, "last_ts": None, "last_min": 0.0,
+            "segs": "", "marks": "",
+            "static": _timeline_ticks(total_span) + _timeline_legend(),
+        }
+    # 新しい入力だけ追記
+    for entry in logs[cache["n_raw"]:]:
+        ts = _log_ts(entry)
+        if ts is None:
+            continue
+        m = (ts - t0).total_seconds() / 60.0
+        if cache["n_events"]:
+            # 次の入力が来たので直前の区間は確定
+            cache["segs"] += _timeline_segment(cache["last_min"], m - cache["last_min"], total_span)
+        else:
+            cache["first_kind"] = entry.get("kind")
+        info = f'{ts.strftime("%H:%M:%S")}｜先頭から{m:.1f}分｜合計{int(entry.get("合計", 0))}｜kind:{entry.get("kind","-")}'
+        cache["marks"] += _marker_svg(_tl_x(m, total_span), _TL_Y, _TL_MARK_R, entry.get("kind",""), info)
+        cache["n_events"] += 1
+        cache["last_ts"] = ts
+        cache["last_min"] = m
+    cache["n_raw"] = len(logs)
+    cache["last_raw_ts"] = logs[-1]["ts"]
+    mem.put("count_log_svg", cache)
 
+    # 最後の区間は now まで
+    tail = _timeline_segment(cache["last_min"], (now - cache["last_ts"]).total_seconds() / 60.0, total_span)
+    W, H, Y = _TL_W, _TL_H, _TL_Y
     svg = f'''
 <svg viewBox="0 0 {W} {H+28}" width="100%" height="auto" xmlns="http://www.w3.org/2000/svg">
   <rect x="0" y="0" width="{W}" height="{H+28}" fill="transparent"/>
-  <line x1="{PAD_L}" y1="{Y}" x2="{W-PAD_R}" y2="{Y}" stroke="#52525b" stroke-width="1"/>
-  {"".join(segs)}
-  {"".join(marks)}
-  {axis}
-  {axis_label}
-  {"".join(lg)}
+  <line x1="{_TL_PAD_L}" y1="{Y}" x2="{W-_TL_PAD_R}" y2="{Y}" stroke="#52525b" stroke-width="1"/>
+  {cache["segs"]}{tail}
+  {cache["marks"]}
+  {cache["static"]}
 </svg>
     '''
     st.subheader(title)
     st.markdown(svg, unsafe_allow_html=True)
 
     # フッタ
-    df = df.sort_values("ts").reset_index(drop=True)
-    if df.iloc[0]["kind"] != "start":
-        df = pd.concat([
-            pd.DataFrame([{"ts": df.iloc[0]["ts"], "kind": "start", "合計": 0}]),
-            df
-        ], ignore_index=True)
-
     # 合計経過時間
-    total_elapsed_min = (df["ts"].iloc[-1] - df["ts"].iloc[0]).total_seconds() / 60
+    total_elapsed_min = (cache["last_ts"] - t0).total_seconds() / 60
 
-    # 平均時間
-    intervals_min = df["ts"].diff().iloc[1:].dt.total_seconds().div(60)
-    avg_interval_min = float(intervals_min.mean()) if len(intervals_min) else 0.0
+    # 平均時間（先頭が start でなければ start を補った時と同じ区間数）
+    n_intervals = cache["n_events"] - 1 + (cache["first_kind"] != "start")
+    avg_interval_min = total_elapsed_min / n_intervals if n_intervals else 0.0
+
+    # 退避済みの区間があれば最初の入力から数える（残りの先頭は退避分の続きなので start は補わない）
+    if spilled and spilled.get("since") is not None:
+        total_elapsed_min = (cache["last_ts"] - pd.Timestamp(spilled["since"])).total_seconds() / 60
+        n_intervals = spilled["n"] + cache["n_events"] - 1
+        avg_interval_min = total_elapsed_min / n_intervals if n_intervals else 0.0
 
     # 表示
     st.caption(
@@ -411,12 +1140,14 @@ def render_count_logs(logs, min_span_min=5, warn_minutes=5, title="⏱ カウン
 
 
 if "supabase" not in st.session_state:
-    st.session_state["supabase"] = SupabaseDB()
+    st.session_state["supabase"] = get_db()
 # ------------------ ユーザー選択 or 新規作成 ------------------
 st.sidebar.header("ユーザー選択または新規作成")
 if "usernames" not in st.session_state:
     st.session_state["usernames"] = st.session_state.supabase.get_user()["username"].tolist()
 selected_user = st.sidebar.selectbox("ユーザーを選択", ["新規作成"] + st.session_state["usernames"])
+mem = session_memory()
+mem.username = None if selected_user == "新規作成" else selected_user
 
 # 初期化：前回値と更新時刻をセッションステートに保存
 if "inputs" not in st.session_state:
@@ -432,9 +1163,12 @@ if "last_modified" not in st.session_state:
     if "meal_num"  not in st.session_state: st.session_state.meal_num  = 0
     if "cost"      not in st.session_state: st.session_state.cost      = 7.00
     if "price"     not in st.session_state: st.session_state.price     = 100.00
+    if "plan_runs" not in st.session_state: st.session_state.plan_runs = 40
 # カウントログの初期化
 if "count_logs" not in st.session_state:
     st.session_state.count_logs = []
+if "_spilled_logs" not in st.session_state:
+    st.session_state._spilled_logs = {"since": None, "n": 0, "kinds": {}}
 if "_reset_counts" not in st.session_state:
     st.session_state._reset_counts = False
 if "_last_total" not in st.session_state:
@@ -451,7 +1185,8 @@ if "_last_wipes" not in st.session_state:
 
 # カウントのリセット
 if st.session_state._reset_counts:
-    reset_count()
+    with mem.lock:
+        reset_count()
     st.session_state._reset_counts = False
 
 # 現在時刻
@@ -539,7 +1274,14 @@ else:
         - st.session_state.meal_cost * (st.session_state.meal_num / 5)
     )
     profit = int(profit * 10000)
-    record_count(now)
+    # カウントログは放置セッションの退避（他のセッションのスレッド）と同時に触らないよう、
+    # ロック内で更新し、このランではそのスナップショットを使う
+    with mem.lock:
+        record_count(now)
+        spill_count_logs(selected_user)
+        mem.attach(st.session_state.count_logs, st.session_state._spilled_logs, st.session_state.inputs)
+        count_logs = list(st.session_state.count_logs)
+        spilled_logs = {**st.session_state._spilled_logs, "kinds": dict(st.session_state._spilled_logs["kinds"])}
     count = st.session_state._last_total
 
     html = """
@@ -570,7 +1312,32 @@ else:
 
 
     # カウント履歴の表示
-    render_count_logs(st.session_state.count_logs)
+    render_count_logs(count_logs, spilled=spilled_logs)
+
+    # ------------------ 利益予測 ------------------
+    records_df = get_records_cached(selected_user)
+    st.subheader("🔮 終了時の利益予測")
+    plan_runs = st.number_input("予定周回数（合計）", min_value=0, step=4, key="plan_runs")
+    probs = estimate_run_probs(records_df, count_logs, spilled_logs["kinds"])
+    counts = (st.session_state.frag_45, st.session_state.frag_75, st.session_state.core, st.session_state.wipes)
+    fc = forecast_profit(
+        probs,
+        counts,
+        plan_runs - sum(counts),
+        st.session_state.meal_cost,
+        st.session_state.meal_num,
+        st.session_state.cost,
+        st.session_state.price,
+    )
+    band = fc["percentiles"]
+    col1, col2, col3 = st.columns(3)
+    with col1: st.metric("期待利益", f"{int(fc['mean']):,} G", help=f"標準偏差 {int(fc['std']):,} G")
+    with col2: st.metric("50%の範囲", f"{int(band[25]):,} 〜 {int(band[75]):,} G")
+    with col3: st.metric("90%の範囲", f"{int(band[5]):,} 〜 {int(band[95]):,} G")
+    st.caption(
+        f"残り {fc['remaining_runs']} 周を {fc['n_sims']:,} 回シミュレーション　｜　"
+        + "　".join(f"{k}: {v:.1%}" for k, v in fc["probs"].items())
+    )
 
 
     st.markdown(
@@ -592,9 +1359,11 @@ else:
             "profit": profit,
             "meal_cost": st.session_state.meal_cost,
             "meal_num": st.session_state.meal_num,
+            "minutes": _elapsed_minutes(count_logs, spilled_logs["since"]),
         }
         st.session_state.supabase.add_record(record)
         st.session_state.supabase.update_user_last_activity(selected_user)
+        invalidate_records(selected_user)
         st.success("データを追加しました！")
         st.session_state._flash_msg = ("success", "データを追加しました！")
         st.rerun()
@@ -607,9 +1376,10 @@ else:
         "core":    st.session_state.core,
         "wipes":   st.session_state.wipes,
     }
-    if current_count_inputs != {k: st.session_state.inputs.get(k, None) for k in current_count_inputs}:
-        st.session_state.last_modified = now
-        st.session_state.inputs.update(current_count_inputs)
+    with mem.lock:
+        if current_count_inputs != {k: st.session_state.inputs.get(k, None) for k in current_count_inputs}:
+            st.session_state.last_modified = now
+            st.session_state.inputs.update(current_count_inputs)
     # if st.session_state.last_modified:
     #     st.info(f"最後にカウントを入力した時間: {st.session_state.last_modified.strftime('%H:%M:%S')}")
 
@@ -625,7 +1395,7 @@ else:
     st.divider()
     st.subheader("投入済みデータ")
     st.caption("※表の編集後は『更新内容を保存』ボタンで反映されます（利益・日付は編集不可）")
-    df = st.session_state.supabase.get_records_by_user(selected_user)
+    df = records_df.copy()
     if not df.empty:
         df["date"] = pd.to_datetime(df["date"], errors="coerce")
         df["month"] = df["date"].dt.to_period("M").astype(str)
@@ -652,7 +1422,9 @@ else:
                 "profit": st.column_config.Column("利益", disabled=True),
                 "meal_cost": "料理価格",
                 "meal_num": "飯数",
+                "minutes": "時間(分)",
                 "created_at": st.column_config.Column("", width=0.01, disabled=True),
+                "updated_at": st.column_config.Column("", width=0.01, disabled=True),
             },
             use_container_width=False,
             hide_index=True,
@@ -669,7 +1441,8 @@ else:
             # 更新処理
             for idx, row in edited_df.iterrows():
                 record_id = row["id"]
-                new_values = row.to_dict()
+                # 時間の無い古いレコードなどの NaN は null のまま送る
+                new_values = {k: (None if pd.api.types.is_scalar(v) and pd.isna(v) else v) for k, v in row.to_dict().items()}
                 new_values["date"] = row["date"].strftime("%Y-%m-%d")
                 new_values["profit"] = calculate_profit(
                     new_values["frag_45"],
@@ -692,6 +1465,7 @@ else:
                     st.session_state.supabase.delete_record(del_id)
                 except Exception as e:
                     st.error(f"削除失敗: {e}")
+            invalidate_records(selected_user)
             st.rerun()
             # st.success("保存しました")
 
@@ -751,3 +1525,62 @@ else:
 
         st.altair_chart(line_chart, use_container_width=True)
 
+# ------------------ ランキング ------------------
+st.divider()
+st.write("### 🏆 ランキング")
+col1, col2 = st.columns(2)
+with col1:
+    lb_period = st.radio("期間", ["週", "月"], horizontal=True, key="lb_period")
+with col2:
+    lb_metric = st.radio("指標", ["利益", "核", "G/時間"], horizontal=True, key="lb_metric")
+period = "week" if lb_period == "週" else "month"
+this_period = _period_start(pd.Series([datetime.now(timezone("Asia/Tokyo")).date()]), period).iloc[0]
+lb_df = load_leaderboard(period, this_period.strftime("%Y-%m-%d"))
+if lb_df is None:
+    st.caption("ランキングを取得中です。しばらくしてから再読み込みしてください。")
+elif lb_df.empty:
+    st.caption("この期間のデータはまだありません。")
+else:
+    sort_col = {"利益": "profit", "核": "core", "G/時間": "g_per_hour"}[lb_metric]
+    lb_df = lb_df.dropna(subset=[sort_col]).sort_values(sort_col, ascending=False).reset_index(drop=True)
+    lb_df.index = lb_df.index + 1
+    st.dataframe(
+        lb_df[["username", "profit", "core", "runs", "g_per_hour"]],
+        column_config={
+            "username": "ユーザー",
+            "profit": st.column_config.NumberColumn("利益(G)", format="%d"),
+            "core": "核",
+            "runs": "周回数",
+            "g_per_hour": st.column_config.NumberColumn("G/時間", format="%d"),
+        },
+        use_container_width=True,
+    )
+    st.caption(f"{this_period.strftime('%Y-%m-%d')} から集計（{LEADERBOARD_TTL // 60}分ごとに更新）")
+
+# ------------------ 同期状況 ------------------
+pending = st.session_state.supabase.pending_count()
+if pending:
+    st.sidebar.caption(f"🔄 未同期の変更が {pending} 件あります（{int(REPLICA_SYNC_SECONDS)}秒ごとに再送）")
+rejected = st.session_state.supabase.rejected_changes()
+if not rejected.empty:
+    with st.sidebar.expander(f"⚠️ 反映できなかった変更が {len(rejected)} 件あります", expanded=True):
+        st.dataframe(
+            rejected,
+            column_config={
+                "ts": "日時", "tbl": "テーブル", "op": "操作", "row_id": "ID", "error": "理由",
+            },
+            hide_index=True,
+            use_container_width=True,
+        )
+        if st.button("確認済みにする"):
+            st.session_state.supabase.acknowledge_rejected()
+            st.rerun()
+
+# ------------------ メモリ使用状況 ------------------
+if SHOW_MEMORY_REPORT:
+    with st.sidebar.expander("🧠 メモリ使用状況"):
+        st.caption(
+            f"上限 {SESSION_MEMORY_BUDGET / 1024 / 1024:.0f} MB/セッション　｜　"
+            f"{SESSION_IDLE_SECONDS // 60} 分操作がないとキャッシュを破棄しカウントログを退避"
+        )
+        st.dataframe(memory_report(), hide_index=True, use_container_width=True)